@@ -1,20 +1,139 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+from flask import Flask, Response, abort, render_template, request, jsonify, session, redirect, url_for
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
+import bisect
+import functools
+import hashlib
+import json
 import os
-from sqlalchemy import func
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import redis
+from sqlalchemy import event, func, insert, inspect, select, text, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import aliased
 
 app = Flask(__name__)
-app.config['SECRET_KEY'] = os.urandom(24)
+
+def read_secret_key(path):
+    """Read the secret key stored at path, or None if it is missing or empty"""
+    try:
+        with open(path, 'rb') as f:
+            return f.read() or None
+    except FileNotFoundError:
+        return None
+
+def load_or_create_secret_key(path):
+    """Read the secret key stored at path, generating it on first run"""
+    key = read_secret_key(path)
+    if key:
+        return key
+    
+    # Write the key to a temporary file and link it into place, so no other
+    # worker process can ever read a partially written key
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(os.urandom(24))
+        try:
+            os.link(temp_path, path)
+        except FileExistsError:
+            # Another worker process created it first, unless it is an empty
+            # file left behind by a crash
+            key = read_secret_key(path)
+            if key:
+                return key
+            os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    
+    return read_secret_key(path)
+
+# The secret key must be the same across restarts and worker processes,
+# otherwise sessions stop being recognised
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or load_or_create_secret_key(
+    os.path.join(app.instance_path, 'secret.key'))
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///hospital_queue.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Size the pool for many concurrent dashboard/status polls; with WAL each
+# pooled connection can read concurrently
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': 20,
+    'max_overflow': 40,
+    'pool_pre_ping': True,
+    'pool_recycle': 1800,
+    'connect_args': {'check_same_thread': False}
+}
 
 # Timeout Configuration
 # Grace period after estimated waiting time before auto-removal (in minutes)
 TIMEOUT_GRACE_PERIOD = 1
+# Seconds between background checks for timed-out patients
+TIMEOUT_CHECK_INTERVAL = 30
+
+# Redis Configuration
+# Optional hot-path cache for queue and crowd counts. The database stays
+# the source of truth: every read falls back to SQL when Redis is unavailable.
+REDIS_URL = os.environ.get('REDIS_URL')
+# Seconds to wait before retrying Redis after a failure
+REDIS_RETRY_INTERVAL = 30
+# Attempts at rebuilding the Redis queues while other processes keep writing
+REDIS_REBUILD_ATTEMPTS = 5
+# Seconds between keep-alive comments on idle /api/stream connections
+STREAM_KEEPALIVE_INTERVAL = 15
+
+# Response Cache Configuration
+# Seconds each process reuses a computed dashboard API response when Redis
+# is unavailable. With Redis, responses are reused until the queues change.
+API_CACHE_TTL = 1
 
 db = SQLAlchemy(app)
 
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Tune every new SQLite connection for concurrent readers"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    
+    cursor = dbapi_connection.cursor()
+    # WAL lets dashboard reads run alongside a registration write
+    cursor.execute('PRAGMA journal_mode=WAL')
+    # With WAL, NORMAL only fsyncs at checkpoints and is still crash-safe
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA mmap_size=268435456')  # 256 MB
+    cursor.execute('PRAGMA cache_size=-65536')  # 64 MB
+    cursor.close()
+
+redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=True,
+                                    socket_timeout=0.5) if REDIS_URL else None
+# Redis is only read from once this process has rebuilt its queues from the
+# database, which it does again after every Redis error.
+_redis_synced = False
+# Serializes rebuilds, so each process rebuilds its queues only once
+_redis_sync_lock = threading.Lock()
+# Incremented by every Redis error in this process
+_redis_failures = 0
+_redis_retry_at = 0
+
+# In-process cache of department rows keyed by name, plus an ID to name
+# lookup. Departments are only created by init_db(), so the cache does not
+# need invalidating at runtime.
+_DEPT_CACHE = {}
+_DEPT_NAMES = {}
+
+# Cached dashboard API responses keyed by endpoint:
+# (version, expires_at, body, etag)
+_RESPONSE_CACHE = {}
+# Incremented whenever this process changes the queues
+_response_cache_invalidations = 0
+
 # Database Models
 class Department(db.Model):
     __tablename__ = 'departments'
@@ -29,21 +148,63 @@ class Department(db.Model):
 
 class Patient(db.Model):
     __tablename__ = 'patients'
+    __table_args__ = (
+        # Partial index: only waiting patients are queried by department and
+        # queue number, so served/left/timed-out history stays out of it
+        db.Index('ix_patients_waiting', 'department_id', 'queue_number',
+                 sqlite_where=db.text("status = 'waiting'"),
+                 postgresql_where=db.text("status = 'waiting'")),
+        db.Index('ix_patient_status', 'status'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
-    department = db.Column(db.String(100), nullable=False)
+    department_id = db.Column(db.Integer, db.ForeignKey('departments.id'), nullable=False)
     queue_number = db.Column(db.Integer, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     status = db.Column(db.String(20), default='waiting')  # 'waiting' or 'served'
     
+    @property
+    def department(self):
+        """Name of the patient's department"""
+        return get_department_name(self.department_id)
+    
     def __repr__(self):
         return f'<Patient {self.name} - {self.department}>'
 
+def migrate_db():
+    """Bring an existing database schema up to date with the models"""
+    columns = {column['name'] for column in inspect(db.engine).get_columns('patients')}
+    if 'department_id' not in columns:
+        # Patients used to store the department name. SQLite cannot add a
+        # NOT NULL foreign key to an existing table, so rebuild the table
+        # and resolve each name to its department ID.
+        with db.engine.begin() as conn:
+            for index in Patient.__table__.indexes:
+                conn.execute(text(f'DROP INDEX IF EXISTS {index.name}'))
+            conn.execute(text('ALTER TABLE patients RENAME TO patients_old'))
+            Patient.__table__.create(conn)
+            conn.execute(text(
+                'INSERT INTO patients (id, name, department_id, queue_number, timestamp, status) '
+                'SELECT p.id, p.name, d.id, p.queue_number, p.timestamp, p.status '
+                'FROM patients_old p JOIN departments d ON d.name = p.department'
+            ))
+            conn.execute(text('DROP TABLE patients_old'))
+    
+    # Superseded by the partial ix_patients_waiting index
+    with db.engine.begin() as conn:
+        conn.execute(text('DROP INDEX IF EXISTS ix_patient_dept_status_qnum'))
+    
+    # create_all() only creates missing tables, so indexes added to
+    # existing tables have to be created explicitly (CREATE INDEX IF NOT EXISTS)
+    for index in Patient.__table__.indexes:
+        index.create(bind=db.engine, checkfirst=True)
+
 # Initialize database and default departments
 def init_db():
     with app.app_context():
         db.create_all()
+        migrate_db()
         
         # Check if departments already exist
         if Department.query.count() == 0:
@@ -65,60 +226,361 @@ def init_db():
             
             db.session.commit()
             print("Database initialized with default departments")
+        
+        load_department_cache()
+
+# Department Cache Functions
+def load_department_cache():
+    """Load all departments from the database into the in-process cache"""
+    _DEPT_CACHE.clear()
+    _DEPT_NAMES.clear()
+    for dept in Department.query.order_by(Department.id).all():
+        _DEPT_NAMES[dept.id] = dept.name
+        _DEPT_CACHE[dept.name] = {
+            'id': dept.id,
+            'name': dept.name,
+            'average_service_time': dept.average_service_time,
+            'description': dept.description
+        }
+    return _DEPT_CACHE
+
+def get_departments():
+    """Get cached department data keyed by department name"""
+    if not _DEPT_CACHE:
+        load_department_cache()
+    return _DEPT_CACHE
+
+def get_department_name(department_id):
+    """Get a department's name from its ID using the department cache"""
+    if not _DEPT_NAMES:
+        load_department_cache()
+    return _DEPT_NAMES[department_id]
+
+# Redis Queue Functions
+# Each department's waiting patients are mirrored in a sorted set
+# (queue:{department}:waiting) of patient IDs scored by queue number, so
+# queue lengths are a ZCARD instead of COUNT queries. Served patients are
+# counted with INCR; only actual transitions to 'served' reach Redis, so the
+# counter never double counts.
+#
+# Every queue update also increments the generation key. A rebuild only
+# swaps in sets built from its database snapshot if the generation has not
+# moved since the snapshot was read, so it can never overwrite a concurrent
+# update from another process. Redis can outlive the database and miss
+# updates from a crashed worker, so every process rebuilds the queues before
+# it first uses them instead of trusting whatever Redis already holds.
+REDIS_SERVED_KEY = 'hospital:served'
+REDIS_GENERATION_KEY = 'hospital:queue_generation'
+
+def redis_queue_key(department_name):
+    """Redis key of the sorted set holding a department's waiting patients"""
+    return f'queue:{department_name}:waiting'
+
+def rebuild_redis_queues():
+    """Rebuild the Redis waiting queues and served counter from the database"""
+    for attempt in range(REDIS_REBUILD_ATTEMPTS):
+        generation = redis_client.get(REDIS_GENERATION_KEY)
+        
+        waiting = db.session.query(
+            Patient.id, Patient.department_id, Patient.queue_number
+        ).filter_by(status='waiting').all()
+        _, served = get_db_hospital_counts()
+        
+        members = {redis_queue_key(name): {} for name in get_departments()}
+        for patient_id, department_id, queue_number in waiting:
+            members[redis_queue_key(get_department_name(department_id))][patient_id] = queue_number
+        
+        # Build the new sets under temporary keys first
+        suffix = f':rebuild:{uuid.uuid4().hex}'
+        pipe = redis_client.pipeline()
+        for key, queue in members.items():
+            if queue:
+                pipe.zadd(key + suffix, queue)
+                pipe.expire(key + suffix, 60)
+        pipe.execute()
+        
+        with redis_client.pipeline() as pipe:
+            try:
+                pipe.watch(REDIS_GENERATION_KEY)
+                if pipe.get(REDIS_GENERATION_KEY) != generation:
+                    continue
+                
+                pipe.multi()
+                for key, values in members.items():
+                    if values:
+                        pipe.rename(key + suffix, key)
+                    else:
+                        pipe.delete(key)
+                pipe.set(REDIS_SERVED_KEY, served)
+                # Other processes' cached responses predate the rebuilt sets
+                pipe.incr(REDIS_GENERATION_KEY)
+                pipe.execute()
+                return
+            except redis.WatchError:
+                continue
+            finally:
+                # Leftovers from an aborted attempt
+                redis_client.delete(*[key + suffix for key in members])
+    
+    raise redis.WatchError('Redis queues kept changing during rebuild')
+
+def sync_redis_queues():
+    """
+    Rebuild the Redis queues from the database before using them, returning
+    whether they are in sync
+    """
+    global _redis_synced
+    with _redis_sync_lock:
+        # Another thread may have rebuilt them, or given up on Redis, meanwhile
+        if not _redis_synced and time.monotonic() >= _redis_retry_at:
+            failures = _redis_failures
+            rebuild_redis_queues()
+            # An update lost by another thread during the rebuild may be
+            # missing from its snapshot
+            _redis_synced = _redis_failures == failures
+    return _redis_synced
+
+def redis_failed():
+    """Stop using Redis until it can be rebuilt from the database"""
+    global _redis_synced, _redis_retry_at, _redis_failures
+    # Updates from this process may have been lost, so don't trust the queues
+    _redis_synced = False
+    _redis_failures += 1
+    _redis_retry_at = time.monotonic() + REDIS_RETRY_INTERVAL
+    app.logger.warning('Redis unavailable, falling back to the database', exc_info=True)
+
+def redis_execute(callback):
+    """
+    Run callback(redis_client) and return its result, or None if Redis is
+    not configured, not yet in sync with the database, or fails
+    """
+    if redis_client is None or time.monotonic() < _redis_retry_at:
+        return None
+    
+    try:
+        if not _redis_synced and not sync_redis_queues():
+            return None
+        return callback(redis_client)
+    except redis.WatchError:
+        # Other processes kept updating the queues during the rebuild. Redis
+        # itself is fine, so fall back to the database only for this call.
+        app.logger.info('Redis queues kept changing during rebuild, retrying later')
+        return None
+    except redis.RedisError:
+        redis_failed()
+        return None
+
+def recover_redis():
+    """
+    Rebuild the Redis queues once this process may retry Redis after an
+    error, so other processes stop reading sets that miss its lost updates
+    """
+    if redis_client is not None and not _redis_synced:
+        redis_execute(lambda r: None)
+
+def redis_queue_update(patients):
+    """
+    Add waiting patients to, and remove all others from, their Redis queues,
+    counting patients who were just served
+    """
+    def update(r):
+        pipe = r.pipeline()
+        for patient in patients:
+            key = redis_queue_key(get_department_name(patient.department_id))
+            if patient.status == 'waiting':
+                pipe.zadd(key, {patient.id: patient.queue_number})
+            else:
+                pipe.zrem(key, patient.id)
+            if patient.status == 'served':
+                pipe.incr(REDIS_SERVED_KEY)
+        pipe.incr(REDIS_GENERATION_KEY)
+        pipe.execute()
+    
+    redis_execute(update)
+
+def redis_queue_channel(department_name):
+    """Redis Pub/Sub channel announcing changes to a department's queue"""
+    return f'queue:{department_name}'
+
+def publish_queue_update(department_names):
+    """
+    Announce each changed department to stream subscribers, which reload the
+    counts they display instead of reading them from the event
+    """
+    def publish(r):
+        pipe = r.pipeline(transaction=False)
+        for name in department_names:
+            pipe.publish(redis_queue_channel(name), json.dumps({'department': name}))
+        pipe.execute()
+    
+    redis_execute(publish)
+
+def queue_changed(patients):
+    """Propagate committed patient status changes to Redis and stream subscribers"""
+    redis_queue_update(patients)
+    publish_queue_update({get_department_name(patient.department_id) for patient in patients})
+    invalidate_response_cache()
 
 # Queue Management Functions
-def get_next_queue_number(department_name):
-    """Get the next queue number for a specific department"""
-    last_patient = Patient.query.filter_by(
-        department=department_name,
-        status='waiting'
-    ).order_by(Patient.queue_number.desc()).first()
-    
-    if last_patient:
-        return last_patient.queue_number + 1
-    return 1
-
-def get_queue_position(patient_id):
-    """Get current position in queue for a patient"""
-    patient = Patient.query.get(patient_id)
-    if not patient or patient.status != 'waiting':
+def next_queue_number_subquery(department_id):
+    """Subquery computing the next queue number for a specific department"""
+    return select(
+        func.coalesce(func.max(Patient.queue_number), 0) + 1
+    ).where(
+        Patient.department_id == department_id,
+        Patient.status == 'waiting'
+    ).scalar_subquery()
+
+def get_patient_queue_status(patient_id):
+    """
+    Load a patient together with their queue position and their department's
+    waiting count in a single query. Returns (patient, position, dept_queue_count),
+    with position None if the patient is not waiting, or None if there is no such patient.
+    """
+    other = aliased(Patient)
+    ahead_count = select(func.count()).select_from(other).where(
+        other.department_id == Patient.department_id,
+        other.status == 'waiting',
+        other.queue_number < Patient.queue_number
+    ).scalar_subquery()
+    dept_queue_count = select(func.count()).select_from(other).where(
+        other.department_id == Patient.department_id,
+        other.status == 'waiting'
+    ).scalar_subquery()
+    
+    row = db.session.execute(
+        select(Patient, ahead_count, dept_queue_count).where(Patient.id == patient_id)
+    ).first()
+    if not row:
         return None
     
-    # Count patients ahead in the same department
-    position = Patient.query.filter(
-        Patient.department == patient.department,
-        Patient.status == 'waiting',
-        Patient.queue_number < patient.queue_number
-    ).count() + 1
+    patient, ahead, dept_count = row
+    position = ahead + 1 if patient.status == 'waiting' else None
+    return patient, position, dept_count
+
+def get_new_patient_queue_status(patient):
+    """
+    Get a just registered patient's (position, dept_queue_count) with a
+    single Redis round trip or database query
+    """
+    key = redis_queue_key(get_department_name(patient.department_id))
+    def status(r):
+        pipe = r.pipeline(transaction=False)
+        # The sorted set is scored by queue number, so the rank is the number
+        # of patients ahead
+        pipe.zrank(key, patient.id)
+        pipe.zcard(key)
+        return pipe.execute()
+    
+    result = redis_execute(status)
+    if result is not None and result[0] is not None:
+        rank, dept_queue_count = result
+        return rank + 1, dept_queue_count
+    
+    _, position, dept_queue_count = get_patient_queue_status(patient.id)
+    return position, dept_queue_count
+
+def get_queue_positions(waiting_patients):
+    """
+    Get queue positions keyed by patient ID for all waiting patients, numbered
+    in queue order within each department instead of one COUNT per patient
+    """
+    positions = {}
+    queue_lengths = {}
+    
+    for patient in sorted(waiting_patients, key=lambda p: (p.department_id, p.queue_number)):
+        queue_lengths[patient.department_id] = queue_lengths.get(patient.department_id, 0) + 1
+        positions[patient.id] = queue_lengths[patient.department_id]
     
-    return position
+    return positions
 
 def calculate_waiting_time(department_name, position):
     """Calculate estimated waiting time based on position and average service time"""
-    dept = Department.query.filter_by(name=department_name).first()
+    dept = get_departments().get(department_name)
     if not dept:
         return 0
     
     # Estimated Waiting Time = Position × Average Service Time
-    return (position - 1) * dept.average_service_time
+    return (position - 1) * dept['average_service_time']
+
+def get_waiting_counts():
+    """Get waiting patient counts keyed by department name in a single query"""
+    def count_all(r):
+        pipe = r.pipeline(transaction=False)
+        for name in get_departments():
+            pipe.zcard(redis_queue_key(name))
+        return dict(zip(get_departments(), pipe.execute()))
+    
+    counts = redis_execute(count_all)
+    if counts is not None:
+        return counts
+    
+    # Outer join so departments without waiting patients are counted as 0
+    return dict(
+        db.session.query(Department.name, func.count(Patient.id))
+        .outerjoin(Patient, db.and_(Patient.department_id == Department.id,
+                                    Patient.status == 'waiting'))
+        .group_by(Department.id)
+        .all()
+    )
+
+def get_department_queue_count(department_name):
+    """Get the number of waiting patients in a specific department"""
+    count = redis_execute(lambda r: r.zcard(redis_queue_key(department_name)))
+    if count is not None:
+        return count
+    
+    return db.session.execute(
+        select(func.count()).select_from(Patient).where(
+            Patient.department_id == get_departments()[department_name]['id'],
+            Patient.status == 'waiting'
+        )
+    ).scalar()
+
+def get_hospital_counts():
+    """Get the hospital-wide (waiting, served) patient counts"""
+    def count_all(r):
+        pipe = r.pipeline(transaction=False)
+        for name in get_departments():
+            pipe.zcard(redis_queue_key(name))
+        pipe.get(REDIS_SERVED_KEY)
+        *waiting, served = pipe.execute()
+        return sum(waiting), int(served or 0)
+    
+    counts = redis_execute(count_all)
+    if counts is not None:
+        return counts
+    
+    return get_db_hospital_counts()
+
+def get_db_hospital_counts():
+    """Get the hospital-wide (waiting, served) patient counts from the database"""
+    counts = dict(
+        db.session.query(Patient.status, func.count(Patient.id))
+        .filter(Patient.status.in_(('waiting', 'served')))
+        .group_by(Patient.status)
+        .all()
+    )
+    return counts.get('waiting', 0), counts.get('served', 0)
+
+# Crowd levels, from least to most crowded. The thresholds are the highest
+# count still classified at each level; anything above the last is 'High'.
+# The level dicts are shared between responses and must not be modified.
+CROWD_LEVELS = (
+    {'level': 'Low', 'color': 'success'},
+    {'level': 'Moderate', 'color': 'warning'},
+    {'level': 'High', 'color': 'danger'}
+)
+DEPARTMENT_CROWD_THRESHOLDS = (10, 25)
+HOSPITAL_CROWD_THRESHOLDS = (40, 80)
 
 def get_crowd_level(count):
     """Classify crowd level based on count"""
-    if count <= 10:
-        return {'level': 'Low', 'color': 'success'}
-    elif count <= 25:
-        return {'level': 'Moderate', 'color': 'warning'}
-    else:
-        return {'level': 'High', 'color': 'danger'}
+    return CROWD_LEVELS[bisect.bisect_left(DEPARTMENT_CROWD_THRESHOLDS, count)]
 
 def get_hospital_crowd_level(total_count):
     """Classify overall hospital crowd level"""
-    if total_count <= 40:
-        return {'level': 'Low', 'color': 'success'}
-    elif total_count <= 80:
-        return {'level': 'Moderate', 'color': 'warning'}
-    else:
-        return {'level': 'High', 'color': 'danger'}
+    return CROWD_LEVELS[bisect.bisect_left(HOSPITAL_CROWD_THRESHOLDS, total_count)]
 
 def check_and_remove_timeout_patients():
     """
@@ -127,16 +589,21 @@ def check_and_remove_timeout_patients():
     """
     from datetime import datetime, timedelta
     
-    waiting_patients = Patient.query.filter_by(status='waiting').all()
-    timeout_count = 0
+    waiting_patients = db.session.execute(
+        select(Patient.id, Patient.department_id, Patient.queue_number, Patient.timestamp)
+        .where(Patient.status == 'waiting')
+        .order_by(Patient.department_id, Patient.queue_number)
+    ).all()
+    timed_out_ids = []
+    # Waiting patients kept so far per department. Walking each queue in order
+    # gives every position without a query; patients timed out by this sweep
+    # no longer count towards the positions behind them.
+    queue_lengths = {}
     
     for patient in waiting_patients:
         # Get patient's position and estimated waiting time
-        position = get_queue_position(patient.id)
-        if not position:
-            continue
-            
-        estimated_wait_minutes = calculate_waiting_time(patient.department, position)
+        position = queue_lengths.get(patient.department_id, 0) + 1
+        estimated_wait_minutes = calculate_waiting_time(get_department_name(patient.department_id), position)
         
         # Calculate total allowed time: registration time + estimated wait + grace period
         registration_time = patient.timestamp
@@ -146,13 +613,105 @@ def check_and_remove_timeout_patients():
         current_time = datetime.utcnow()
         if current_time > total_allowed_time:
             # Patient has timed out - mark as timeout
-            patient.status = 'timeout'
-            timeout_count += 1
+            timed_out_ids.append(patient.id)
+        else:
+            queue_lengths[patient.department_id] = position
+    
+    if not timed_out_ids:
+        return 0
+    
+    # Only patients still waiting are timed out: another request or another
+    # worker's sweep may have served, cancelled or timed them out meanwhile
+    timed_out = db.session.execute(
+        update(Patient)
+        .where(Patient.id.in_(timed_out_ids), Patient.status == 'waiting')
+        .values(status='timeout')
+        .returning(Patient.id, Patient.department_id, Patient.queue_number, Patient.status)
+        .execution_options(synchronize_session=False)
+    ).all()
+    db.session.commit()
     
-    if timeout_count > 0:
-        db.session.commit()
+    if timed_out:
+        queue_changed(timed_out)
     
-    return timeout_count
+    return len(timed_out)
+
+# Background Timeout Worker
+# Timed-out patients are swept by a daemon thread in each server process, so
+# the dashboard APIs never write to the database while answering a poll.
+_timeout_worker_lock = threading.Lock()
+_timeout_worker_pid = None
+
+def run_timeout_worker():
+    """Periodically mark patients who didn't show up as timed out"""
+    while True:
+        time.sleep(TIMEOUT_CHECK_INTERVAL)
+        with app.app_context():
+            # Any error must not end the thread, which is never restarted
+            try:
+                check_and_remove_timeout_patients()
+                recover_redis()
+            except Exception:
+                app.logger.exception('Timeout check failed')
+
+@app.before_request
+def start_timeout_worker():
+    """Start the timeout worker in this process if it is not running yet"""
+    global _timeout_worker_pid
+    # Threads don't survive a fork, so Gunicorn workers each start their own
+    if _timeout_worker_pid == os.getpid():
+        return
+    
+    with _timeout_worker_lock:
+        if _timeout_worker_pid != os.getpid():
+            threading.Thread(target=run_timeout_worker, name='timeout-worker', daemon=True).start()
+            _timeout_worker_pid = os.getpid()
+
+# Response Cache Functions
+def response_cache_version():
+    """
+    Version of the queue state seen by this process: its own invalidation
+    count, and the Redis queue generation shared by all processes (None
+    without Redis)
+    """
+    generation = redis_execute(lambda r: r.get(REDIS_GENERATION_KEY))
+    return _response_cache_invalidations, generation
+
+def cached_response(view):
+    """
+    Reuse a JSON view's response while the queues are unchanged and answer
+    If-None-Match requests with 304 Not Modified
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        now = time.monotonic()
+        version = response_cache_version()
+        cached = _RESPONSE_CACHE.get(request.endpoint)
+        # The generation changes with every queue update in any process;
+        # without it, other processes' updates only show after the TTL
+        if (cached is None or cached[0] != version
+                or (version[1] is None and cached[1] <= now)):
+            body = view(*args, **kwargs).get_data()
+            cached = (version, now + API_CACHE_TTL, body, hashlib.md5(body).hexdigest())
+            # A body computed across an invalidation may predate the change
+            if _response_cache_invalidations == version[0]:
+                _RESPONSE_CACHE[request.endpoint] = cached
+        
+        _, _, body, etag = cached
+        response = app.response_class(body, mimetype='application/json')
+        response.set_etag(etag)
+        # Browsers must revalidate, so an event-driven refresh never gets a
+        # stale copy, but unchanged responses still cost only a 304
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+    
+    return wrapper
+
+def invalidate_response_cache():
+    """Drop cached API responses after the queues change"""
+    global _response_cache_invalidations
+    _response_cache_invalidations += 1
+    _RESPONSE_CACHE.clear()
 
 # Routes
 @app.route('/')
@@ -164,7 +723,7 @@ def landing():
 def register():
     """Queue registration page"""
     if request.method == 'GET':
-        departments = Department.query.all()
+        departments = get_departments().values()
         return render_template('register.html', departments=departments)
     
     # POST - Handle registration
@@ -176,32 +735,31 @@ def register():
         return jsonify({'error': 'Name and department are required'}), 400
     
     # Verify department exists
-    dept = Department.query.filter_by(name=department).first()
+    dept = get_departments().get(department)
     if not dept:
         return jsonify({'error': 'Invalid department'}), 400
     
-    # Create new patient
-    queue_number = get_next_queue_number(department)
-    patient = Patient(
-        name=name,
-        department=department,
-        queue_number=queue_number
-    )
-    
-    db.session.add(patient)
+    # Create new patient, assigning the queue number within the same INSERT
+    patient = db.session.execute(
+        insert(Patient).values(
+            name=name,
+            department_id=dept['id'],
+            queue_number=next_queue_number_subquery(dept['id'])
+        ).returning(Patient.id, Patient.department_id, Patient.queue_number, Patient.status)
+    ).one()
     db.session.commit()
+    queue_changed([patient])
+    queue_number = patient.queue_number
     
-    # Calculate position and waiting time
-    position = get_queue_position(patient.id)
-    waiting_time = calculate_waiting_time(department, position)
+    # Patients who registered after this one count towards the crowd level,
+    # but are not ahead of them
+    position, dept_queue_count = get_new_patient_queue_status(patient)
     
     # Get department crowd level
-    dept_queue_count = Patient.query.filter_by(
-        department=department,
-        status='waiting'
-    ).count()
     crowd_level = get_crowd_level(dept_queue_count)
     
+    waiting_time = calculate_waiting_time(department, position)
+    
     # Store patient ID in session
     session['patient_id'] = patient.id
     
@@ -217,20 +775,18 @@ def register():
 @app.route('/status/<int:user_id>')
 def status(user_id):
     """User status page - live queue position tracker"""
-    patient = Patient.query.get_or_404(user_id)
+    result = get_patient_queue_status(user_id)
+    if result is None:
+        abort(404)
+    patient, position, dept_queue_count = result
     
     if patient.status == 'served':
         position = 0
         waiting_time = 0
     else:
-        position = get_queue_position(user_id)
         waiting_time = calculate_waiting_time(patient.department, position) if position else 0
     
     # Get department crowd level
-    dept_queue_count = Patient.query.filter_by(
-        department=patient.department,
-        status='waiting'
-    ).count()
     crowd_level = get_crowd_level(dept_queue_count)
     
     return render_template('status.html', 
@@ -245,31 +801,27 @@ def dashboard():
     return render_template('dashboard.html')
 
 @app.route('/api/department_status')
+@cached_response
 def department_status():
     """API endpoint for department-wise queue data"""
-    # Check and remove timed-out patients
-    check_and_remove_timeout_patients()
-    
-    departments = Department.query.all()
+    departments = get_departments().values()
+    waiting_counts = get_waiting_counts()
     dept_data = []
     
     for dept in departments:
         # Get waiting patients count
-        queue_count = Patient.query.filter_by(
-            department=dept.name,
-            status='waiting'
-        ).count()
+        queue_count = waiting_counts.get(dept['name'], 0)
         
         # Calculate average waiting time
-        avg_waiting_time = dept.average_service_time * (queue_count / 2 if queue_count > 0 else 0)
+        avg_waiting_time = dept['average_service_time'] * (queue_count / 2 if queue_count > 0 else 0)
         
         # Get crowd level
         crowd_level = get_crowd_level(queue_count)
         
         dept_data.append({
-            'name': dept.name,
+            'name': dept['name'],
             'queue_count': queue_count,
-            'average_service_time': dept.average_service_time,
+            'average_service_time': dept['average_service_time'],
             'avg_waiting_time': round(avg_waiting_time, 1),
             'crowd_level': crowd_level['level'],
             'crowd_color': crowd_level['color']
@@ -278,13 +830,10 @@ def department_status():
     return jsonify(dept_data)
 
 @app.route('/api/hospital_overview')
+@cached_response
 def hospital_overview():
     """API endpoint for hospital-wide metrics"""
-    # Check and remove timed-out patients
-    check_and_remove_timeout_patients()
-    
-    total_waiting = Patient.query.filter_by(status='waiting').count()
-    total_served = Patient.query.filter_by(status='served').count()
+    total_waiting, total_served = get_hospital_counts()
     
     # Get overall hospital crowd level
     hospital_crowd = get_hospital_crowd_level(total_waiting)
@@ -300,20 +849,18 @@ def hospital_overview():
 @app.route('/api/patient_status/<int:patient_id>')
 def patient_status_api(patient_id):
     """API endpoint for individual patient status updates"""
-    patient = Patient.query.get_or_404(patient_id)
+    result = get_patient_queue_status(patient_id)
+    if result is None:
+        abort(404)
+    patient, position, dept_queue_count = result
     
     if patient.status == 'served':
         position = 0
         waiting_time = 0
     else:
-        position = get_queue_position(patient_id)
         waiting_time = calculate_waiting_time(patient.department, position) if position else 0
     
     # Get department crowd level
-    dept_queue_count = Patient.query.filter_by(
-        department=patient.department,
-        status='waiting'
-    ).count()
     crowd_level = get_crowd_level(dept_queue_count)
     
     return jsonify({
@@ -330,14 +877,12 @@ def patient_status_api(patient_id):
 @app.route('/api/waiting_patients')
 def waiting_patients():
     """API endpoint to get list of all waiting patients"""
-    # Check and remove timed-out patients
-    check_and_remove_timeout_patients()
-    
     patients = Patient.query.filter_by(status='waiting').order_by(Patient.timestamp).all()
+    positions = get_queue_positions(patients)
     
     patient_list = []
     for patient in patients:
-        position = get_queue_position(patient.id)
+        position = positions[patient.id]
         waiting_time = calculate_waiting_time(patient.department, position) if position else 0
         
         patient_list.append({
@@ -352,6 +897,40 @@ def waiting_patients():
     
     return jsonify(patient_list)
 
+@app.route('/api/stream')
+def queue_stream():
+    """
+    Server-Sent Events stream of queue changes for the dashboard. Each open
+    stream holds a server thread, so patient status pages keep polling.
+    """
+    # Subscribe before responding so no update published in between is lost
+    def subscribe(r):
+        pubsub = r.pubsub(ignore_subscribe_messages=True)
+        pubsub.psubscribe(redis_queue_channel('*'))
+        return pubsub
+    
+    pubsub = redis_execute(subscribe)
+    if pubsub is None:
+        # The dashboard falls back to polling the status APIs
+        return jsonify({'error': 'Live updates unavailable'}), 503
+    
+    def generate():
+        try:
+            while True:
+                message = pubsub.get_message(timeout=STREAM_KEEPALIVE_INTERVAL)
+                if message is None:
+                    # Keeps proxies from closing the connection and detects gone clients
+                    yield ': keep-alive\n\n'
+                else:
+                    yield f"data: {message['data']}\n\n"
+        except redis.RedisError:
+            app.logger.warning('Queue stream lost its Redis connection', exc_info=True)
+        finally:
+            pubsub.close()
+    
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/leave_queue', methods=['POST'])
 def leave_queue():
     """API endpoint for patients to leave/cancel their queue registration"""
@@ -360,20 +939,27 @@ def leave_queue():
     if not patient_id:
         return jsonify({'error': 'Patient ID required'}), 400
     
-    patient = Patient.query.get(patient_id)
-    if not patient:
-        return jsonify({'error': 'Patient not found'}), 404
+    # Mark patient as cancelled (left the queue), unless they were served or
+    # timed out since they loaded the page
+    patient = db.session.execute(
+        update(Patient)
+        .where(Patient.id == patient_id, Patient.status == 'waiting')
+        .values(status='cancelled')
+        .returning(Patient.id, Patient.name, Patient.department_id, Patient.queue_number, Patient.status)
+        .execution_options(synchronize_session=False)
+    ).first()
+    db.session.commit()
     
-    if patient.status != 'waiting':
+    if not patient:
+        if not db.session.get(Patient, patient_id):
+            return jsonify({'error': 'Patient not found'}), 404
         return jsonify({'error': 'Patient is not in queue'}), 400
     
-    # Mark patient as cancelled (left the queue)
-    patient.status = 'cancelled'
-    db.session.commit()
+    queue_changed([patient])
     
     return jsonify({
         'success': True, 
-        'message': f'{patient.name} has left the queue for {patient.department}'
+        'message': f'{patient.name} has left the queue for {get_department_name(patient.department_id)}'
     })
 
 @app.route('/api/mark_served', methods=['POST'])
@@ -384,13 +970,24 @@ def mark_served():
     if not patient_id:
         return jsonify({'error': 'Patient ID required'}), 400
     
-    patient = Patient.query.get(patient_id)
-    if not patient:
-        return jsonify({'error': 'Patient not found'}), 404
-    
-    patient.status = 'served'
+    # Only a patient who is not served yet changes status, so marking the
+    # same patient twice never counts them twice
+    patient = db.session.execute(
+        update(Patient)
+        .where(Patient.id == patient_id, Patient.status != 'served')
+        .values(status='served')
+        .returning(Patient.id, Patient.name, Patient.department_id, Patient.queue_number, Patient.status)
+        .execution_options(synchronize_session=False)
+    ).first()
     db.session.commit()
     
+    if patient:
+        queue_changed([patient])
+    else:
+        patient = db.session.get(Patient, patient_id)
+        if not patient:
+            return jsonify({'error': 'Patient not found'}), 404
+    
     return jsonify({'success': True, 'message': f'Patient {patient.name} marked as served'})
 
 if __name__ == '__main__':
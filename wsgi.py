@@ -0,0 +1,12 @@
+"""
+WSGI entry point for running the app under a production server, e.g.
+
+    gunicorn --preload -w 4 --threads 16 -b 0.0.0.0:5000 wsgi:app
+"""
+from app import app, db, init_db
+
+init_db()
+
+# Workers forked after --preload must open their own database connections
+with app.app_context():
+    db.engine.dispose()